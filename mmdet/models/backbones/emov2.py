@@ -1,13 +1,11 @@
-import math
-from functools import partial
+import zipfile
+from itertools import accumulate
 
 import torch
-from einops import rearrange, reduce, repeat
-from torchvision.ops import DeformConv2d
 import torch.nn as nn
 import torch.nn.functional as F
-from timm.layers.activations import *
 from timm.layers import DropPath, trunc_normal_
+from mmcv.cnn import fuse_conv_bn
 from .emov2_basic_modules import get_norm, get_act, ConvNormAct, LayerScale2D
 from torch.nn.modules.batchnorm import _BatchNorm
 from mmdet.registry import MODELS
@@ -25,6 +23,65 @@ def get_stem(dim_in, dim_mid):
     return stem
 
 
+def get_attn_dtype(attn_dtype='none'):
+    attn_dtype_dict = {
+        'none': None,
+        'fp16': torch.float16,
+        'bf16': torch.bfloat16,
+    }
+    return attn_dtype_dict[attn_dtype]
+
+
+def window_partition_remote(x, n1, n2):
+    # b c (h1 n1) (w1 n2) -> (b n1 n2) c h1 w1
+    B, C, H, W = x.shape
+    h1, w1 = H // n1, W // n2
+    x = x.reshape(B, C, h1, n1, w1, n2).permute(0, 3, 5, 1, 2, 4)
+    return x.reshape(B * n1 * n2, C, h1, w1)
+
+
+def window_merge_remote(x, n1, n2):
+    # (b n1 n2) c h1 w1 -> b c (h1 n1) (w1 n2)
+    b, C, h1, w1 = x.shape
+    B = b // (n1 * n2)
+    x = x.reshape(B, n1, n2, C, h1, w1).permute(0, 3, 4, 1, 5, 2)
+    return x.reshape(B, C, h1 * n1, w1 * n2)
+
+
+def window_partition_close(x, n1, n2):
+    # b c (n1 h1) (n2 w1) -> (b n1 n2) c h1 w1
+    B, C, H, W = x.shape
+    h1, w1 = H // n1, W // n2
+    x = x.reshape(B, C, n1, h1, n2, w1).permute(0, 2, 4, 1, 3, 5)
+    return x.reshape(B * n1 * n2, C, h1, w1)
+
+
+def window_merge_close(x, n1, n2):
+    # (b n1 n2) c h1 w1 -> b c (n1 h1) (n2 w1)
+    b, C, h1, w1 = x.shape
+    B = b // (n1 * n2)
+    x = x.reshape(B, n1, n2, C, h1, w1).permute(0, 3, 1, 4, 2, 5)
+    return x.reshape(B, C, n1 * h1, n2 * w1)
+
+
+def window_partition_hybrid(x, n1, n2):
+    # remote and close windows stacked along the batch dim with a single copy:
+    # b c H W -> (2 b n1 n2) c h1 w1
+    B, C, H, W = x.shape
+    h1, w1 = H // n1, W // n2
+    x_remote = x.reshape(B, C, h1, n1, w1, n2).permute(0, 3, 5, 1, 2, 4)
+    x_close = x.reshape(B, C, n1, h1, n2, w1).permute(0, 2, 4, 1, 3, 5)
+    return torch.stack([x_remote, x_close]).reshape(2 * B * n1 * n2, C, h1, w1)
+
+
+def fuse_qkv_pre_hook(module, state_dict, prefix, *args):
+    # merge the separate `qk` / `v` projections of older checkpoints into the fused `qkv` one
+    for suffix in ['conv.weight', 'conv.bias']:
+        qk_key, v_key = f'{prefix}qk.{suffix}', f'{prefix}v.{suffix}'
+        if qk_key in state_dict and v_key in state_dict:
+            state_dict[f'{prefix}qkv.{suffix}'] = torch.cat([state_dict.pop(qk_key), state_dict.pop(v_key)], dim=0)
+
+
 # --> conv
 class Conv(nn.Module):
 
@@ -41,15 +98,29 @@ class Conv(nn.Module):
 class EW_MHSA_Remote(nn.Module):
 
     def __init__(self, dim_in, dim_mid, norm_layer='bn_2d', act_layer='relu', dim_head=64, window_size=7,
-                 qkv_bias=False, attn_drop=0., drop=0., drop_path=0., v_group=False, attn_pre=False, ls_value=1e-6):
+                 qkv_bias=False, attn_drop=0., drop=0., drop_path=0., v_group=False, attn_pre=False, ls_value=1e-6,
+                 attn_dtype='none'):
         super().__init__()
         self.dim_head = dim_head
         self.window_size = window_size
         self.num_head = dim_in // dim_head
         self.scale = self.dim_head ** -0.5
         self.attn_pre = attn_pre
-        self.qk = ConvNormAct(dim_in, int(dim_in * 2), kernel_size=1, bias=qkv_bias, norm_layer='none', act_layer='none')
-        self.v = ConvNormAct(dim_in, dim_mid, kernel_size=1, groups=self.num_head if v_group else 1, bias=qkv_bias, norm_layer='none', act_layer=act_layer, inplace=inplace)
+        self.attn_dtype = get_attn_dtype(attn_dtype)
+        self.dim_in = dim_in
+        self.dim_mid = dim_mid
+        # q, k and v share one 1x1 projection unless v is applied after attention or is grouped
+        self.fuse_qkv = not attn_pre and not v_group
+        if self.fuse_qkv:
+            self.qkv = ConvNormAct(dim_in, int(dim_in * 2) + dim_mid, kernel_size=1, bias=qkv_bias, norm_layer='none',
+                                   act_layer='none')
+            self.v_act = get_act(act_layer)(inplace=False)
+            self._register_load_state_dict_pre_hook(fuse_qkv_pre_hook, with_module=True)
+        else:
+            self.qk = ConvNormAct(dim_in, int(dim_in * 2), kernel_size=1, bias=qkv_bias, norm_layer='none',
+                                  act_layer='none')
+            self.v = ConvNormAct(dim_in, dim_mid, kernel_size=1, groups=self.num_head if v_group else 1, bias=qkv_bias,
+                                 norm_layer='none', act_layer=act_layer, inplace=inplace)
         self.attn_drop = nn.Dropout(attn_drop)
 
     def forward(self, x):
@@ -62,35 +133,37 @@ class EW_MHSA_Remote(nn.Module):
         pad_l, pad_t = 0, 0
         pad_r = (window_size_W - W % window_size_W) % window_size_W
         pad_b = (window_size_H - H % window_size_H) % window_size_H
-        x = F.pad(x, (pad_l, pad_r, pad_t, pad_b, 0, 0,))
+        if pad_r > 0 or pad_b > 0:
+            x = F.pad(x, (pad_l, pad_r, pad_t, pad_b, 0, 0,))
         n1, n2 = (H + pad_b) // window_size_H, (W + pad_r) // window_size_W
-        x = rearrange(x, 'b c (h1 n1) (w1 n2) -> (b n1 n2) c h1 w1', n1=n1, n2=n2).contiguous()
+        x = window_partition_remote(x, n1, n2)
 
         # attention
         b, c, h, w = x.shape
-        qk = self.qk(x)
-        qk = rearrange(qk, 'b (qk heads dim_head) h w -> qk b heads (h w) dim_head', qk=2, heads=self.num_head,
-                       dim_head=self.dim_head).contiguous()
+        if self.fuse_qkv:
+            qk, v = self.qkv(x).split([self.dim_in * 2, self.dim_mid], dim=1)
+            v = self.v_act(v)
+        else:
+            qk = self.qk(x)
+            v = x if self.attn_pre else self.v(x)
+        # the fused SDPA kernels need a unit stride on dim_head, so q / k / v are copied once
+        qk = qk.reshape(b, 2, self.num_head, self.dim_head, h * w).permute(1, 0, 2, 4, 3).contiguous()
         q, k = qk[0], qk[1]
-        attn_map = (q @ k.transpose(-2, -1)) * self.scale
-        attn_map = attn_map.softmax(dim=-1)
-        attn_map = self.attn_drop(attn_map)
+        v = v.reshape(b, self.num_head, -1, h * w).transpose(-2, -1).contiguous()
+        if self.attn_dtype is not None:
+            q, k, v = q.to(self.attn_dtype), k.to(self.attn_dtype), v.to(self.attn_dtype)
+        dropout_p = self.attn_drop.p if self.training else 0.
+        x_spa = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, scale=self.scale)
+        if self.attn_dtype is not None:
+            x_spa = x_spa.to(x.dtype)
+        x_spa = x_spa.transpose(-2, -1).reshape(b, -1, h, w)
         if self.attn_pre:
-            x = rearrange(x, 'b (heads dim_head) h w -> b heads (h w) dim_head', heads=self.num_head).contiguous()
-            x_spa = attn_map @ x
-            x_spa = rearrange(x_spa, 'b heads (h w) dim_head -> b (heads dim_head) h w', heads=self.num_head, h=h,
-                              w=w).contiguous()
             x_spa = self.v(x_spa)
-        else:
-            v = self.v(x)
-            v = rearrange(v, 'b (heads dim_head) h w -> b heads (h w) dim_head', heads=self.num_head).contiguous()
-            x_spa = attn_map @ v
-            x_spa = rearrange(x_spa, 'b heads (h w) dim_head -> b (heads dim_head) h w', heads=self.num_head, h=h, w=w).contiguous()
 
         # unpadding
-        x = rearrange(x_spa, '(b n1 n2) c h1 w1 -> b c (h1 n1) (w1 n2)', n1=n1, n2=n2).contiguous()
+        x = window_merge_remote(x_spa, n1, n2)
         if pad_r > 0 or pad_b > 0:
-            x = x[:, :, :H, :W].contiguous()
+            x = x[:, :, :H, :W]
         return x
 
 
@@ -98,17 +171,29 @@ class EW_MHSA_Remote(nn.Module):
 class EW_MHSA_Close(nn.Module):
 
     def __init__(self, dim_in, dim_mid, norm_layer='bn_2d', act_layer='relu', dim_head=64, window_size=7,
-                 qkv_bias=False, attn_drop=0., drop=0., drop_path=0., v_group=False, attn_pre=False, ls_value=1e-6):
+                 qkv_bias=False, attn_drop=0., drop=0., drop_path=0., v_group=False, attn_pre=False, ls_value=1e-6,
+                 attn_dtype='none'):
         super().__init__()
         self.dim_head = dim_head
         self.window_size = window_size
         self.num_head = dim_in // dim_head
         self.scale = self.dim_head ** -0.5
         self.attn_pre = attn_pre
-        self.qk = ConvNormAct(dim_in, int(dim_in * 2), kernel_size=1, bias=qkv_bias, norm_layer='none',
-                              act_layer='none')
-        self.v = ConvNormAct(dim_in, dim_mid, kernel_size=1, groups=self.num_head if v_group else 1, bias=qkv_bias,
-                             norm_layer='none', act_layer=act_layer, inplace=inplace)
+        self.attn_dtype = get_attn_dtype(attn_dtype)
+        self.dim_in = dim_in
+        self.dim_mid = dim_mid
+        # q, k and v share one 1x1 projection unless v is applied after attention or is grouped
+        self.fuse_qkv = not attn_pre and not v_group
+        if self.fuse_qkv:
+            self.qkv = ConvNormAct(dim_in, int(dim_in * 2) + dim_mid, kernel_size=1, bias=qkv_bias, norm_layer='none',
+                                   act_layer='none')
+            self.v_act = get_act(act_layer)(inplace=False)
+            self._register_load_state_dict_pre_hook(fuse_qkv_pre_hook, with_module=True)
+        else:
+            self.qk = ConvNormAct(dim_in, int(dim_in * 2), kernel_size=1, bias=qkv_bias, norm_layer='none',
+                                  act_layer='none')
+            self.v = ConvNormAct(dim_in, dim_mid, kernel_size=1, groups=self.num_head if v_group else 1, bias=qkv_bias,
+                                 norm_layer='none', act_layer=act_layer, inplace=inplace)
         self.attn_drop = nn.Dropout(attn_drop)
 
     def forward(self, x):
@@ -121,55 +206,66 @@ class EW_MHSA_Close(nn.Module):
         pad_l, pad_t = 0, 0
         pad_r = (window_size_W - W % window_size_W) % window_size_W
         pad_b = (window_size_H - H % window_size_H) % window_size_H
-        x = F.pad(x, (pad_l, pad_r, pad_t, pad_b, 0, 0,))
+        if pad_r > 0 or pad_b > 0:
+            x = F.pad(x, (pad_l, pad_r, pad_t, pad_b, 0, 0,))
         n1, n2 = (H + pad_b) // window_size_H, (W + pad_r) // window_size_W
-        # x = rearrange(x, 'b c (h1 n1) (w1 n2) -> (b n1 n2) c h1 w1', n1=n1, n2=n2).contiguous()
-        x = rearrange(x, 'b c (n1 h1) (n2 w1) -> (b n1 n2) c h1 w1', n1=n1, n2=n2).contiguous()
+        x = window_partition_close(x, n1, n2)
 
         # attention
         b, c, h, w = x.shape
-        qk = self.qk(x)
-        qk = rearrange(qk, 'b (qk heads dim_head) h w -> qk b heads (h w) dim_head', qk=2, heads=self.num_head,
-                       dim_head=self.dim_head).contiguous()
+        if self.fuse_qkv:
+            qk, v = self.qkv(x).split([self.dim_in * 2, self.dim_mid], dim=1)
+            v = self.v_act(v)
+        else:
+            qk = self.qk(x)
+            v = x if self.attn_pre else self.v(x)
+        # the fused SDPA kernels need a unit stride on dim_head, so q / k / v are copied once
+        qk = qk.reshape(b, 2, self.num_head, self.dim_head, h * w).permute(1, 0, 2, 4, 3).contiguous()
         q, k = qk[0], qk[1]
-        attn_map = (q @ k.transpose(-2, -1)) * self.scale
-        attn_map = attn_map.softmax(dim=-1)
-        attn_map = self.attn_drop(attn_map)
+        v = v.reshape(b, self.num_head, -1, h * w).transpose(-2, -1).contiguous()
+        if self.attn_dtype is not None:
+            q, k, v = q.to(self.attn_dtype), k.to(self.attn_dtype), v.to(self.attn_dtype)
+        dropout_p = self.attn_drop.p if self.training else 0.
+        x_spa = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, scale=self.scale)
+        if self.attn_dtype is not None:
+            x_spa = x_spa.to(x.dtype)
+        x_spa = x_spa.transpose(-2, -1).reshape(b, -1, h, w)
         if self.attn_pre:
-            x = rearrange(x, 'b (heads dim_head) h w -> b heads (h w) dim_head', heads=self.num_head).contiguous()
-            x_spa = attn_map @ x
-            x_spa = rearrange(x_spa, 'b heads (h w) dim_head -> b (heads dim_head) h w', heads=self.num_head, h=h,
-                              w=w).contiguous()
             x_spa = self.v(x_spa)
-        else:
-            v = self.v(x)
-            v = rearrange(v, 'b (heads dim_head) h w -> b heads (h w) dim_head', heads=self.num_head).contiguous()
-            x_spa = attn_map @ v
-            x_spa = rearrange(x_spa, 'b heads (h w) dim_head -> b (heads dim_head) h w', heads=self.num_head, h=h,
-                              w=w).contiguous()
 
         # unpadding
-        # x = rearrange(x_spa, '(b n1 n2) c h1 w1 -> b c (h1 n1) (w1 n2)', n1=n1, n2=n2).contiguous()
-        x = rearrange(x_spa, '(b n1 n2) c h1 w1 -> b c (n1 h1) (n2 w1)', n1=n1, n2=n2).contiguous()
+        x = window_merge_close(x_spa, n1, n2)
         if pad_r > 0 or pad_b > 0:
-            x = x[:, :, :H, :W].contiguous()
+            x = x[:, :, :H, :W]
         return x
 
 
 class EW_MHSA_Hybrid(nn.Module):
 
     def __init__(self, dim_in, dim_mid, norm_layer='bn_2d', act_layer='relu', dim_head=64, window_size=7,
-                 qkv_bias=False, attn_drop=0., drop=0., drop_path=0., v_group=False, attn_pre=False, ls_value=1e-6):
+                 qkv_bias=False, attn_drop=0., drop=0., drop_path=0., v_group=False, attn_pre=False, ls_value=1e-6,
+                 attn_dtype='none'):
         super().__init__()
         self.dim_head = dim_head
         self.window_size = window_size
         self.num_head = dim_in // dim_head
         self.scale = self.dim_head ** -0.5
         self.attn_pre = attn_pre
-        self.qk = ConvNormAct(dim_in, int(dim_in * 2), kernel_size=1, bias=qkv_bias, norm_layer='none',
-                              act_layer='none')
-        self.v = ConvNormAct(dim_in, dim_mid, kernel_size=1, groups=self.num_head if v_group else 1, bias=qkv_bias,
-                             norm_layer='none', act_layer=act_layer, inplace=inplace)
+        self.attn_dtype = get_attn_dtype(attn_dtype)
+        self.dim_in = dim_in
+        self.dim_mid = dim_mid
+        # q, k and v share one 1x1 projection unless v is applied after attention or is grouped
+        self.fuse_qkv = not attn_pre and not v_group
+        if self.fuse_qkv:
+            self.qkv = ConvNormAct(dim_in, int(dim_in * 2) + dim_mid, kernel_size=1, bias=qkv_bias, norm_layer='none',
+                                   act_layer='none')
+            self.v_act = get_act(act_layer)(inplace=False)
+            self._register_load_state_dict_pre_hook(fuse_qkv_pre_hook, with_module=True)
+        else:
+            self.qk = ConvNormAct(dim_in, int(dim_in * 2), kernel_size=1, bias=qkv_bias, norm_layer='none',
+                                  act_layer='none')
+            self.v = ConvNormAct(dim_in, dim_mid, kernel_size=1, groups=self.num_head if v_group else 1, bias=qkv_bias,
+                                 norm_layer='none', act_layer=act_layer, inplace=inplace)
         self.attn_drop = nn.Dropout(attn_drop)
 
     def forward(self, x):
@@ -182,68 +278,54 @@ class EW_MHSA_Hybrid(nn.Module):
         pad_l, pad_t = 0, 0
         pad_r = (window_size_W - W % window_size_W) % window_size_W
         pad_b = (window_size_H - H % window_size_H) % window_size_H
-        x = F.pad(x, (pad_l, pad_r, pad_t, pad_b, 0, 0,))
+        if pad_r > 0 or pad_b > 0:
+            x = F.pad(x, (pad_l, pad_r, pad_t, pad_b, 0, 0,))
         n1, n2 = (H + pad_b) // window_size_H, (W + pad_r) // window_size_W
 
-        x_remote = rearrange(x, 'b c (h1 n1) (w1 n2) -> (b n1 n2) c h1 w1', n1=n1, n2=n2).contiguous()
-        x_close = rearrange(x, 'b c (n1 h1) (n2 w1) -> (b n1 n2) c h1 w1', n1=n1, n2=n2).contiguous()
-
-        qk = self.qk(x)
-        qk_remote = rearrange(qk, 'b c (h1 n1) (w1 n2) -> (b n1 n2) c h1 w1', n1=n1, n2=n2).contiguous()
-        qk_close = rearrange(qk, 'b c (n1 h1) (n2 w1) -> (b n1 n2) c h1 w1', n1=n1, n2=n2).contiguous()
-
-        # ==> attention
-        b, c, h, w = x_remote.shape
-
-        qk_remote = rearrange(qk_remote, 'b (qk heads dim_head) h w -> qk b heads (h w) dim_head', qk=2, heads=self.num_head, dim_head=self.dim_head).contiguous()
-        qk_close = rearrange(qk_close, 'b (qk heads dim_head) h w -> qk b heads (h w) dim_head', qk=2, heads=self.num_head, dim_head=self.dim_head).contiguous()
-
-        attn_map_remote = (qk_remote[0] @ qk_remote[1].transpose(-2, -1)) * self.scale
-        attn_map_remote = attn_map_remote.softmax(dim=-1)
-        attn_map_remote = self.attn_drop(attn_map_remote)
-        attn_map_close = (qk_close[0] @ qk_close[1].transpose(-2, -1)) * self.scale
-        attn_map_close = attn_map_close.softmax(dim=-1)
-        attn_map_close = self.attn_drop(attn_map_close)
-
+        if self.fuse_qkv:
+            qk, v = self.qkv(x).split([self.dim_in * 2, self.dim_mid], dim=1)
+            v = self.v_act(v)
+        else:
+            qk = self.qk(x)
+            v = x if self.attn_pre else self.v(x)
+
+        # ==> attention, remote and close windows stacked along the batch dim to share one kernel
+        qk = window_partition_hybrid(qk, n1, n2)
+        v = window_partition_hybrid(v, n1, n2)
+        b, c, h, w = qk.shape
+        # the fused SDPA kernels need a unit stride on dim_head, so q / k / v are copied once
+        qk = qk.reshape(b, 2, self.num_head, self.dim_head, h * w).permute(1, 0, 2, 4, 3).contiguous()
+        q, k = qk[0], qk[1]
+        v = v.reshape(b, self.num_head, -1, h * w).transpose(-2, -1).contiguous()
+        if self.attn_dtype is not None:
+            q, k, v = q.to(self.attn_dtype), k.to(self.attn_dtype), v.to(self.attn_dtype)
+
+        dropout_p = self.attn_drop.p if self.training else 0.
+        x_spa = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, scale=self.scale)
+        if self.attn_dtype is not None:
+            x_spa = x_spa.to(x.dtype)
+        x_spa = x_spa.transpose(-2, -1).reshape(b, -1, h, w)
+        x_spa_remote, x_spa_close = x_spa.chunk(2, dim=0)
+        x_spa_remote = window_merge_remote(x_spa_remote, n1, n2)
         if self.attn_pre:
-            x_remote = rearrange(x_remote, 'b (heads dim_head) h w -> b heads (h w) dim_head', heads=self.num_head).contiguous()
-            x_spa_remote = attn_map_remote @ x_remote
-            x_spa_remote = rearrange(x_spa_remote, 'b heads (h w) dim_head -> b (heads dim_head) h w', heads=self.num_head, h=h, w=w).contiguous()
-            x_spa_remote = rearrange(x_spa_remote, '(b n1 n2) c h1 w1 -> b c (h1 n1) (w1 n2)', n1=n1, n2=n2).contiguous()
-
-            x_close = rearrange(x_close, 'b (heads dim_head) h w -> b heads (h w) dim_head', heads=self.num_head).contiguous()
-            x_spa_close = attn_map_close @ x_close
-            x_spa_close = rearrange(x_spa_close, 'b heads (h w) dim_head -> b (heads dim_head) h w', heads=self.num_head, h=h, w=w).contiguous()
-            x_spa_close = rearrange(x_spa_close, '(b n1 n2) c h1 w1 -> b c (h1 n1) (w1 n2)', n1=n1, n2=n2).contiguous()
-
-            x_spa = x_spa_remote + x_spa_close
-            x_spa = self.v(x_spa)
+            # attn_pre weights were trained with the close windows merged back in the remote layout
+            x_spa_close = window_merge_remote(x_spa_close, n1, n2)
         else:
-            v = self.v(x)
-            v_remote = rearrange(v, 'b c (h1 n1) (w1 n2) -> (b n1 n2) c h1 w1', n1=n1, n2=n2).contiguous()
-            v_close = rearrange(v, 'b c (n1 h1) (n2 w1) -> (b n1 n2) c h1 w1', n1=n1, n2=n2).contiguous()
-
-            v_remote = rearrange(v_remote, 'b (heads dim_head) h w -> b heads (h w) dim_head', heads=self.num_head).contiguous()
-            x_spa_remote = attn_map_remote @ v_remote
-            x_spa_remote = rearrange(x_spa_remote, 'b heads (h w) dim_head -> b (heads dim_head) h w', heads=self.num_head, h=h, w=w).contiguous()
-            x_spa_remote = rearrange(x_spa_remote, '(b n1 n2) c h1 w1 -> b c (h1 n1) (w1 n2)', n1=n1, n2=n2).contiguous()
-
-            v_close = rearrange(v_close, 'b (heads dim_head) h w -> b heads (h w) dim_head', heads=self.num_head).contiguous()
-            x_spa_close = attn_map_close @ v_close
-            x_spa_close = rearrange(x_spa_close, 'b heads (h w) dim_head -> b (heads dim_head) h w', heads=self.num_head, h=h, w=w).contiguous()
-            x_spa_close = rearrange(x_spa_close, '(b n1 n2) c h1 w1 -> b c (n1 h1) (n2 w1)', n1=n1, n2=n2).contiguous()
-            x_spa = x_spa_remote + x_spa_close
+            x_spa_close = window_merge_close(x_spa_close, n1, n2)
+        x_spa = x_spa_remote + x_spa_close if torch.is_grad_enabled() else x_spa_remote.add_(x_spa_close)
+        if self.attn_pre:
+            x_spa = self.v(x_spa)
 
         # unpadding
         if pad_r > 0 or pad_b > 0:
-            x_spa = x_spa[:, :, :H, :W].contiguous()
+            x_spa = x_spa[:, :, :H, :W]
         return x_spa
 
 class iiRMB(nn.Module):
 
     def __init__(self, dim_in, dim_out, norm_in=True, has_skip=True, exp_ratio=1.0, norm_layer='bn_2d',
                  act_layer='relu', dw_ks=3, stride=1, dim_head=64, window_size=7, hybrid_eops=[0], conv_ks=1, conv_groups=1, qkv_bias=False,
-                 attn_drop=0., drop=0., drop_path=0., v_group=False, attn_pre=False, ls_value=1e-6):
+                 attn_drop=0., drop=0., drop_path=0., v_group=False, attn_pre=False, ls_value=1e-6, attn_dtype='none'):
         super().__init__()
         self.norm = get_norm(norm_layer)(dim_in) if norm_in else nn.Identity()
         dim_mid = int(dim_in * exp_ratio)
@@ -256,13 +338,16 @@ class iiRMB(nn.Module):
                 eop = Conv(dim_in, dim_mid, kernel_size=conv_ks, groups=conv_groups, bias=qkv_bias, norm_layer='none', act_layer=act_layer, inplace=inplace)
             elif eop_idx == 1:
                 eop = EW_MHSA_Remote(dim_in, dim_mid, norm_layer=norm_layer, act_layer=act_layer, dim_head=dim_head, window_size=window_size,
-                                     qkv_bias=qkv_bias, attn_drop=attn_drop, drop=drop, drop_path=drop_path, v_group=v_group, attn_pre=attn_pre, ls_value=ls_value)
+                                     qkv_bias=qkv_bias, attn_drop=attn_drop, drop=drop, drop_path=drop_path, v_group=v_group, attn_pre=attn_pre, ls_value=ls_value,
+                                     attn_dtype=attn_dtype)
             elif eop_idx == 2:
                 eop = EW_MHSA_Close(dim_in, dim_mid, norm_layer=norm_layer, act_layer=act_layer, dim_head=dim_head, window_size=window_size,
-                                    qkv_bias=qkv_bias, attn_drop=attn_drop, drop=drop, drop_path=drop_path, v_group=v_group, attn_pre=attn_pre, ls_value=ls_value)
+                                    qkv_bias=qkv_bias, attn_drop=attn_drop, drop=drop, drop_path=drop_path, v_group=v_group, attn_pre=attn_pre, ls_value=ls_value,
+                                    attn_dtype=attn_dtype)
             elif eop_idx == 3:
                 eop = EW_MHSA_Hybrid(dim_in, dim_mid, norm_layer=norm_layer, act_layer=act_layer, dim_head=dim_head, window_size=window_size,
-                                     qkv_bias=qkv_bias, attn_drop=attn_drop, drop=drop, drop_path=drop_path, v_group=v_group, attn_pre=attn_pre, ls_value=ls_value)
+                                     qkv_bias=qkv_bias, attn_drop=attn_drop, drop=drop, drop_path=drop_path, v_group=v_group, attn_pre=attn_pre, ls_value=ls_value,
+                                     attn_dtype=attn_dtype)
             else:
                 eop = None
             if eop:
@@ -284,7 +369,10 @@ class iiRMB(nn.Module):
         xs = []
         for eop in self.eops:
             xs.append(eop(x))
-        x = sum(xs) if len(self.eops) > 1 else xs[0]
+        # accumulate in place when no graph is recorded, the eop outputs are freshly allocated
+        x = xs[0]
+        for x_eop in xs[1:]:
+            x = x + x_eop if torch.is_grad_enabled() else x.add_(x_eop)
 
         x_l = self.conv_local(x)
         x = (x + x_l) if self.has_skip else x_l
@@ -313,25 +401,35 @@ class EMO2(nn.Module):
                  conv_kss=[1, 1, 1, 1],
                  conv_groupss=[1, 1, 1, 1],
                  qkv_bias=True, attn_drop=0., drop=0., drop_path=0.,
-                 v_group=False, attn_pre=False, ls_value=1e-6,
-                 sync_bn=False, out_indices=(1, 2, 3, 4), pretrained=None, frozen_stages=-1, norm_eval=False):
+                 v_group=False, attn_pre=False, ls_value=1e-6, attn_dtype='none', allow_tf32=False,
+                 channels_last=False, compile_blocks=False, sync_bn=False, out_indices=(1, 2, 3, 4), pretrained=None, frozen_stages=-1, norm_eval=False):
         super().__init__()
         self.sync_bn = sync_bn
-        self.out_indices = out_indices
+        self.num_stages = len(depths) + 1
+        # negative indices count from the last stage
+        for i in out_indices:
+            assert -self.num_stages <= i < self.num_stages, f'out_indices {i} out of range'
+        self.out_indices = tuple(i % self.num_stages for i in out_indices)
+        self.out_indices_set = set(self.out_indices)
         self.pretrained = pretrained
         self.frozen_stages = frozen_stages
         self.norm_eval = norm_eval
+        self.channels_last = channels_last
+        if allow_tf32:
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
 
         self.num_classes = num_classes
         assert num_classes > 0
-        dprs = [x.item() for x in torch.linspace(0, drop_path, sum(depths))]
+        dprs = torch.linspace(0, drop_path, sum(depths)).tolist()
+        cum_depths = [0] + list(accumulate(depths))
         emb_dim_pre = embed_dims[0] // 2
         self.stage0 = get_stem(dim_in, emb_dim_pre)
         fea_size = img_size // 2
         for i in range(len(depths)):
             fea_size = fea_size // 2
             layers = []
-            dpr = dprs[sum(depths[:i]):sum(depths[:i + 1])]
+            dpr = dprs[cum_depths[i]:cum_depths[i + 1]]
             for j in range(depths[i]):
                 if j == 0:
                     stride, has_skip, hybrid_eops, exp_ratio, conv_ks, conv_groups = 2, False, [0], exp_ratios[
@@ -347,14 +445,16 @@ class EMO2(nn.Module):
                     stride=stride, dim_head=dim_heads[i], window_size=window_sizes[i], hybrid_eops=hybrid_eops,
                     conv_ks=conv_ks, conv_groups=conv_groups, qkv_bias=qkv_bias, attn_drop=attn_drop, drop=drop,
                     drop_path=dpr[j], v_group=v_group,
-                    attn_pre=attn_pre, ls_value=ls_value
+                    attn_pre=attn_pre, ls_value=ls_value, attn_dtype=attn_dtype
                 ))
                 emb_dim_pre = embed_dims[i]
             self.__setattr__(f'stage{i + 1}', nn.ModuleList(layers))
 
+        self._compile_blocks() if compile_blocks else None
         self._init_weights()
         self._sync_bn() if sync_bn else None
         self._freeze_stages()
+        self.to(memory_format=torch.channels_last) if channels_last else None
 
     def _init_weights(self):
         if self.pretrained is None:
@@ -367,13 +467,18 @@ class EMO2(nn.Module):
                     nn.init.constant_(m.bias, 0)
                     nn.init.constant_(m.weight, 1.0)
         else:
-            state_dict = torch.load(self.pretrained, map_location='cpu')
-            self_state_dict = self.state_dict()
-            for k, v in state_dict.items():
-                if k in self_state_dict.keys():
-                    self_state_dict.update({k: v})
-            self.load_state_dict(self_state_dict, strict=True)
-            print(f'load ckpt from {self.pretrained}')
+            # non-strict loading skips the classification head while letting the
+            # load_state_dict pre-hooks convert the projection layout of older checkpoints
+            # only zipfile checkpoints can be memory-mapped, legacy ones are read as before
+            state_dict = torch.load(self.pretrained, map_location='cpu', mmap=zipfile.is_zipfile(self.pretrained))
+            missing, unexpected = self.load_state_dict(state_dict, strict=False)
+            print(f'load ckpt from {self.pretrained}; missing={len(missing)} unexpected={len(unexpected)}')
+
+    def _compile_blocks(self):
+        # only the conv-only blocks, attention blocks change shape with the window padding
+        for m in self.modules():
+            if isinstance(m, iiRMB) and m.hybrid_eops == [0]:
+                m.compile(dynamic=True)
 
     def _sync_bn(self):
         self.stage0 = torch.nn.SyncBatchNorm.convert_sync_batchnorm(self.stage0)
@@ -407,33 +512,36 @@ class EMO2(nn.Module):
         self.head = nn.Linear(self.pre_dim, num_classes) if num_classes > 0 else nn.Identity()
 
     def check_bn(self):
+        stats = []
         for name, m in self.named_modules():
-            if isinstance(m, nn.modules.batchnorm._NormBase):
-                m.running_mean = torch.nan_to_num(m.running_mean, nan=0, posinf=1, neginf=-1)
-                m.running_var = torch.nan_to_num(m.running_var, nan=0, posinf=1, neginf=-1)
+            if isinstance(m, nn.modules.batchnorm._NormBase) and m.track_running_stats:
+                stats += [m.running_mean, m.running_var]
+        if not stats:
+            return
+        # sanitize all running stats through one flat buffer instead of one kernel per tensor
+        flat = torch.cat([t.flatten() for t in stats]).nan_to_num_(nan=0, posinf=1, neginf=-1)
+        torch._foreach_copy_(stats, flat.split([t.numel() for t in stats]))
 
     # m.running_mean.nan_to_num_(nan=0, posinf=1, neginf=-1)
     # m.running_var.nan_to_num_(nan=0, posinf=1, neginf=-1)
 
+    def fuse(self):
+        """Fold the BatchNorm of each conv-bn pair into the conv for
+        deployment, the pre-norm BatchNorm of iiRMB has no preceding conv and
+        is kept."""
+        assert not self.training, 'fuse() folds the running stats, call eval() first'
+        return fuse_conv_bn(self)
+
     def forward(self, x):
-        out = []
-        for blk in self.stage0:
-            x = blk(x)
-        out.append(x)
-        for blk in self.stage1:
-            x = blk(x)
-        out.append(x)
-        for blk in self.stage2:
-            x = blk(x)
-        out.append(x)
-        for blk in self.stage3:
-            x = blk(x)
-        out.append(x)
-        for blk in self.stage4:
-            x = blk(x)
-        out.append(x)
-        out = tuple([out[i] for i in self.out_indices])
-        return out
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        out = {}
+        for i in range(self.num_stages):
+            for blk in getattr(self, f'stage{i}'):
+                x = blk(x)
+            if i in self.out_indices_set:
+                out[i] = x
+        return tuple(out[i] for i in self.out_indices)
 
     def _freeze_stages(self):
         for i in range(0, self.frozen_stages + 1):
@@ -0,0 +1,260 @@
+import pytest
+import torch
+from einops import rearrange
+
+from mmdet.models.backbones.emov2 import (EMO2, EW_MHSA_Close, EW_MHSA_Hybrid,
+                                          EW_MHSA_Remote, window_merge_close,
+                                          window_merge_remote,
+                                          window_partition_close,
+                                          window_partition_hybrid,
+                                          window_partition_remote)
+
+
+def _to_unfused_state_dict(state_dict):
+    # split the fused `qkv` projection back into the `qk` / `v` layout of
+    # older checkpoints
+    old_state_dict = {}
+    for k, v in state_dict.items():
+        if '.qkv.' in k or k.startswith('qkv.'):
+            # input channels of the 1x1 projection
+            dim_in = state_dict[k.replace('.bias', '.weight')].shape[1]
+            qk, v_ = v.split([dim_in * 2, v.shape[0] - dim_in * 2], dim=0)
+            old_state_dict[k.replace('qkv.', 'qk.')] = qk
+            old_state_dict[k.replace('qkv.', 'v.')] = v_
+        else:
+            old_state_dict[k] = v
+    return old_state_dict
+
+
+def test_emov2_window_helpers():
+    # test the window partition / merge helpers against the einops patterns
+    x = torch.randn(2, 8, 21, 14)
+    n1, n2 = 3, 2
+    x_remote = window_partition_remote(x, n1, n2)
+    assert torch.equal(
+        x_remote,
+        rearrange(
+            x, 'b c (h1 n1) (w1 n2) -> (b n1 n2) c h1 w1', n1=n1, n2=n2))
+    x_close = window_partition_close(x, n1, n2)
+    assert torch.equal(
+        x_close,
+        rearrange(
+            x, 'b c (n1 h1) (n2 w1) -> (b n1 n2) c h1 w1', n1=n1, n2=n2))
+    assert torch.equal(
+        window_partition_hybrid(x, n1, n2), torch.cat([x_remote, x_close]))
+
+    assert torch.equal(
+        window_merge_remote(x_remote, n1, n2),
+        rearrange(
+            x_remote, '(b n1 n2) c h1 w1 -> b c (h1 n1) (w1 n2)', n1=n1,
+            n2=n2))
+    assert torch.equal(window_merge_remote(x_remote, n1, n2), x)
+    assert torch.equal(
+        window_merge_close(x_close, n1, n2),
+        rearrange(
+            x_close, '(b n1 n2) c h1 w1 -> b c (n1 h1) (n2 w1)', n1=n1,
+            n2=n2))
+    assert torch.equal(window_merge_close(x_close, n1, n2), x)
+
+
+@pytest.mark.parametrize('attn_pre', [False, True])
+@pytest.mark.parametrize('attn_cls',
+                         [EW_MHSA_Remote, EW_MHSA_Close, EW_MHSA_Hybrid])
+def test_emov2_attention(attn_cls, attn_pre):
+    # test forward with and without window padding
+    dim_mid = 64 if attn_pre else 128
+    attn = attn_cls(
+        64, dim_mid, act_layer='gelu', dim_head=32, window_size=7,
+        attn_pre=attn_pre)
+    attn.eval()
+    for size in [(14, 14), (17, 12), (5, 9)]:
+        x = torch.randn(2, 64, *size)
+        x_out = attn(x)
+        assert x_out.shape == torch.Size([2, dim_mid, *size])
+
+    # test training forward and backward
+    attn.train()
+    x = torch.randn(2, 64, 17, 12, requires_grad=True)
+    attn(x).sum().backward()
+    assert x.grad.shape == x.shape
+
+
+@pytest.mark.parametrize('attn_cls',
+                         [EW_MHSA_Remote, EW_MHSA_Close, EW_MHSA_Hybrid])
+def test_emov2_load_unfused_qkv(attn_cls):
+    # test loading separate `qk` / `v` weights into the fused projection
+    attn = attn_cls(64, 128, dim_head=32, qkv_bias=True)
+    attn.eval()
+    assert attn.fuse_qkv
+    old_state_dict = _to_unfused_state_dict(attn.state_dict())
+    assert 'qk.conv.weight' in old_state_dict
+    assert 'v.conv.bias' in old_state_dict
+
+    new_attn = attn_cls(64, 128, dim_head=32, qkv_bias=True)
+    new_attn.eval()
+    new_attn.load_state_dict(old_state_dict)
+    x = torch.randn(1, 64, 17, 12)
+    with torch.no_grad():
+        assert torch.equal(attn(x), new_attn(x))
+
+    # grouped v keeps the separate projections
+    attn = attn_cls(64, 128, dim_head=32, v_group=True)
+    assert not attn.fuse_qkv
+    assert hasattr(attn, 'qk') and hasattr(attn, 'v')
+
+
+def test_emov2_backbone(tmp_path):
+    cfg = dict(
+        depths=[1, 2, 3, 2],
+        embed_dims=[32, 48, 64, 96],
+        dim_heads=[16, 16, 16, 16],
+        hybrid_eopss=[[0], [0], [1, 2], [3]],
+        out_indices=(2, 3, 4))
+
+    # test forward
+    model = EMO2(**cfg)
+    model.eval()
+    imgs = torch.randn(2, 3, 96, 128)
+    with torch.no_grad():
+        feats = model(imgs)
+    assert len(feats) == 3
+    assert feats[0].shape == torch.Size([2, 48, 12, 16])
+    assert feats[1].shape == torch.Size([2, 64, 6, 8])
+    assert feats[2].shape == torch.Size([2, 96, 3, 4])
+
+    # test negative out_indices
+    neg_model = EMO2(**dict(cfg, out_indices=(-1, 2)))
+    neg_model.eval()
+    with torch.no_grad():
+        neg_feats = neg_model(imgs)
+    assert len(neg_feats) == 2
+    assert neg_feats[0].shape == torch.Size([2, 96, 3, 4])
+    assert neg_feats[1].shape == torch.Size([2, 48, 12, 16])
+
+    # out-of-range out_indices
+    with pytest.raises(AssertionError):
+        EMO2(**dict(cfg, out_indices=(5, )))
+    with pytest.raises(AssertionError):
+        EMO2(**dict(cfg, out_indices=(-6, )))
+
+    # test loading a checkpoint with the unfused `qk` / `v` layout
+    checkpoint = tmp_path / 'emov2.pth'
+    old_state_dict = _to_unfused_state_dict(model.state_dict())
+    old_state_dict['head.weight'] = torch.zeros(3)
+    torch.save(old_state_dict, checkpoint)
+    new_model = EMO2(**cfg, pretrained=str(checkpoint))
+    new_model.eval()
+    with torch.no_grad():
+        for feat, new_feat in zip(feats, new_model(imgs)):
+            assert torch.equal(feat, new_feat)
+
+
+def test_emov2_fuse():
+    model = EMO2(
+        depths=[1, 2, 1, 1],
+        embed_dims=[32, 48, 64, 96],
+        dim_heads=[16, 16, 16, 16],
+        hybrid_eopss=[[0], [0], [1], [1]])
+    for m in model.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.running_mean.uniform_(-1, 1)
+            m.running_var.uniform_(0.5, 2)
+
+    # folding is only allowed in eval mode
+    with pytest.raises(AssertionError):
+        model.fuse()
+
+    model.eval()
+    imgs = torch.randn(1, 3, 64, 64)
+    with torch.no_grad():
+        feats = model(imgs)
+        model.fuse()
+        fused_feats = model(imgs)
+    for feat, fused_feat in zip(feats, fused_feats):
+        assert torch.allclose(feat, fused_feat, atol=1e-5)
+    # only the iiRMB pre-norms in the bn_2d stages are kept
+    assert sum(
+        isinstance(m, torch.nn.BatchNorm2d) for m in model.modules()) == 3
+
+
+def test_emov2_check_bn():
+    model = EMO2(
+        depths=[1, 2, 1, 1],
+        embed_dims=[32, 48, 64, 96],
+        dim_heads=[16, 16, 16, 16],
+        hybrid_eopss=[[0], [0], [1], [1]])
+    bns = [m for m in model.modules() if isinstance(m, torch.nn.BatchNorm2d)]
+    assert len(bns) > 1
+    buffers = []
+    for bn in bns:
+        bn.running_mean[:3] = torch.tensor(
+            [float('nan'), float('inf'), -float('inf')])
+        bn.running_var[:3] = torch.tensor(
+            [float('nan'), float('inf'), -float('inf')])
+        buffers.append((bn.running_mean, bn.running_var))
+
+    model.check_bn()
+    for bn, (running_mean, running_var) in zip(bns, buffers):
+        # sanitized in place
+        assert bn.running_mean is running_mean
+        assert bn.running_var is running_var
+        assert bn.running_mean[:3].tolist() == [0., 1., -1.]
+        assert bn.running_var[:3].tolist() == [0., 1., -1.]
+        assert torch.isfinite(bn.running_mean).all()
+        assert torch.isfinite(bn.running_var).all()
+
+    # norm layers without running stats are skipped
+    for bn in bns:
+        bn.track_running_stats = False
+        bn.running_mean = None
+        bn.running_var = None
+    model.check_bn()
+
+
+def test_emov2_attn_dtype():
+    cfg = dict(
+        depths=[1, 1, 2, 2],
+        embed_dims=[32, 48, 64, 96],
+        dim_heads=[16, 16, 16, 16],
+        hybrid_eopss=[[0], [0], [1, 2], [3]])
+    model = EMO2(**cfg)
+    model.eval()
+    bf16_model = EMO2(**cfg, attn_dtype='bf16')
+    bf16_model.eval()
+    bf16_model.load_state_dict(model.state_dict())
+
+    imgs = torch.randn(1, 3, 96, 128)
+    with torch.no_grad():
+        feats = model(imgs)
+        bf16_feats = bf16_model(imgs)
+    for feat, bf16_feat in zip(feats, bf16_feats):
+        # only the attention runs in bf16, its output is cast back
+        assert bf16_feat.dtype == torch.float32
+        assert (feat - bf16_feat).abs().max() <= 1e-2 * feat.abs().max()
+
+    with pytest.raises(KeyError):
+        EMO2(**cfg, attn_dtype='fp8')
+
+
+def test_emov2_channels_last():
+    cfg = dict(
+        depths=[1, 1, 2, 2],
+        embed_dims=[32, 48, 64, 96],
+        dim_heads=[16, 16, 16, 16],
+        hybrid_eopss=[[0], [0], [1, 2], [3]])
+    model = EMO2(**cfg)
+    model.eval()
+    cl_model = EMO2(**cfg, channels_last=True)
+    cl_model.eval()
+    cl_model.load_state_dict(model.state_dict())
+    for m in cl_model.modules():
+        if isinstance(m, torch.nn.Conv2d):
+            assert m.weight.is_contiguous(memory_format=torch.channels_last)
+
+    # 6x8 and 3x4 attention stages are padded to the 7x7 window
+    imgs = torch.randn(2, 3, 96, 128)
+    with torch.no_grad():
+        feats = model(imgs)
+        cl_feats = cl_model(imgs)
+    for feat, cl_feat in zip(feats, cl_feats):
+        assert torch.allclose(feat, cl_feat, atol=1e-5)